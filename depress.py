@@ -7,16 +7,45 @@ depress.py
 """
 import argparse
 import json
+import mmap
+import os
 import pathlib
 import struct
 import sys
 import zlib
+from concurrent.futures import ThreadPoolExecutor
+
+try:  # 可选依赖：pip install deflate（libdeflate 绑定），已知解压后大小时一次性解压更快
+    import deflate
+except ImportError:
+    deflate = None
+
+try:  # 可选依赖：pip install orjson，大索引导出比标准库 json 快数倍
+    import orjson
+except ImportError:
+    orjson = None
+
+
+_HDR_S = struct.Struct("<4sIII")  # 全局头：magic、扩展头偏移、保留 x2
+_EXT_S = struct.Struct("<6I")  # 扩展头（24 字节）
+_ENTRY_S = struct.Struct("<QQQI24s")  # 索引条目定长部分（52 字节）
 
 
 class PakError(Exception):
     """ERROR"""
 
 
+# 解压失败时可能抛出的异常类型（libdeflate 绑定有自己的异常类）
+_INFLATE_ERRORS = (zlib.error,) + ((deflate.DeflateError,) if deflate is not None else ())
+
+
+def inflate_raw(payload, size: int) -> bytes:
+    """raw DEFLATE 解压；索引里已有解压后大小，libdeflate 可直接一次解到目标缓冲区，否则回退到 zlib。"""
+    if deflate is not None:
+        return deflate.deflate_decompress(payload, size)
+    return zlib.decompress(payload, wbits=-15)
+
+
 def read_header(pak_bytes: bytes):
     """
     读取并验证 PAK 头。
@@ -27,7 +56,7 @@ def read_header(pak_bytes: bytes):
     if len(pak_bytes) < 16:
         raise PakError("文件长度不足 16 字节，无法包含 PAK 头")
 
-    magic, raw_header, _r1, _r2 = struct.unpack_from("<4sIII", pak_bytes, 0)
+    magic, raw_header, _r1, _r2 = _HDR_S.unpack_from(pak_bytes, 0)
     if magic != b"PAK\x00":
         raise PakError(f"魔数不匹配: {magic!r}")
 
@@ -40,8 +69,7 @@ def read_header(pak_bytes: bytes):
     for candidate in candidates:
         if candidate + 24 > len(pak_bytes):
             continue
-        ext = pak_bytes[candidate : candidate + 24]
-        idx_rel, unk1, root_count, idx_u, idx_c, unk2 = struct.unpack("<6I", ext)
+        idx_rel, unk1, root_count, idx_u, idx_c, unk2 = _EXT_S.unpack_from(pak_bytes, candidate)
         idx_off = candidate + idx_rel
         data_off = idx_off + idx_c
         if idx_u and idx_c and data_off <= len(pak_bytes):
@@ -60,35 +88,66 @@ def read_header(pak_bytes: bytes):
     raise PakError("未找到合法的扩展头")
 
 
-def parse_entries(index_data: bytes, start: int, count: int, prefix: pathlib.Path):
+def scan_entries(index_data: bytes, pos: int, count: int, records: list, name_spans: list) -> int:
     """
-    递归解析索引。
-    - 每个条目：offset(int64) + usize(int64) + csize(int64) + flags(uint32) + time(24 bytes) + Shift-JIS 名字\0
-    - flags & 0x10 表示目录，usize 存放子项数量；否则为文件，offset/usize/csize 为文件参数。
+    扫描索引条目，只记录定长字段和名字的字节范围，不做解码；返回扫描结束的位置。
+    - records 追加 (父目录在 records 中的下标, offset, usize, csize, flags, time_bytes)
+    - name_spans 追加 (名字起点, 名字终点)
+    目录子项紧跟在目录条目之后，用显式栈代替递归：不受递归深度限制，也省去每层的函数调用。
     """
-    pos = start
-    entries = []
+    # 循环内频繁用到的方法/常量提前绑定到局部变量，省去每条目的属性查找
+    unpack_entry = _ENTRY_S.unpack_from
+    find = index_data.find
+    index_len = len(index_data)
+    stack = [[count, None]]  # 每层：[剩余条目数, 父目录下标]
+
+    while stack:
+        level = stack[-1]
+        if not level[0]:
+            stack.pop()
+            continue
+        level[0] -= 1
 
-    for _ in range(count):
-        if pos + 52 > len(index_data):
+        if pos + 52 > index_len:
             raise PakError("索引数据不足，读条目头失败")
 
-        offset, usize, csize, flags, time_bytes = struct.unpack_from("<QQQI24s", index_data, pos)
-        name_end = index_data.find(b"\x00", pos + 52)
+        offset, usize, csize, flags, time_bytes = unpack_entry(index_data, pos)
+        name_end = find(b"\x00", pos + 52)
         if name_end == -1:
             raise PakError("文件名未找到结尾的 0 字节")
 
-        name = index_data[pos + 52 : name_end].decode("shift_jis", errors="replace")
+        name_spans.append((pos + 52, name_end))
+        records.append((level[1], offset, usize, csize, flags, time_bytes))
         pos = name_end + 1
 
-        attrs = flags
-        path = prefix / name if prefix != pathlib.Path() else pathlib.Path(name)
+        if flags & 0x10:  # 目录：usize 为子项数量，子项紧跟在后面
+            stack.append([usize, len(records) - 1])
+
+    return pos
+
+
+def parse_entries(index_data: bytes, start: int, count: int, prefix: pathlib.Path):
+    """
+    解析索引（目录条目后紧跟其子项）。
+    - 每个条目：offset(int64) + usize(int64) + csize(int64) + flags(uint32) + time(24 bytes) + Shift-JIS 名字\0
+    - flags & 0x10 表示目录，usize 存放子项数量；否则为文件，offset/usize/csize 为文件参数。
+    - 名字先收集起来，用 \0 拼接后一次性解码再切开（Shift-JIS 无状态，且 \0 不会出现在名字或双字节尾字节里）。
+    """
+    records = []
+    name_spans = []
+    pos = scan_entries(index_data, start, count, records, name_spans)
+    names = b"\x00".join([index_data[s:e] for s, e in name_spans]).decode("shift_jis", errors="replace").split("\x00")
+
+    entries = []
+    at_root = prefix == pathlib.Path()
+    for (parent, offset, usize, csize, attrs, time_bytes), name in zip(records, names):
+        if parent is not None:
+            path = entries[parent]["path"] / name
+        else:
+            path = pathlib.Path(name) if at_root else prefix / name
 
         if attrs & 0x10:  # 目录
-            child_count = usize
-            entries.append({"type": "dir", "path": path, "child_count": child_count, "attributes": attrs, "time_bytes": time_bytes})
-            pos, child_entries = parse_entries(index_data, pos, child_count, path)
-            entries.extend(child_entries)
+            entries.append({"type": "dir", "path": path, "child_count": usize, "attributes": attrs, "time_bytes": time_bytes})
         else:  # 文件
             entries.append(
                 {
@@ -106,7 +165,7 @@ def parse_entries(index_data: bytes, start: int, count: int, prefix: pathlib.Pat
 
 
 def extract_file(pak_bytes: bytes, entry, base_offset: int, out_dir: pathlib.Path):
-    """按索引信息切出数据段，必要时用 raw DEFLATE 解压，再落盘。"""
+    """按索引信息切出数据段，必要时用 raw DEFLATE 解压，再落盘（目标目录需事先建好）。"""
     abs_off = base_offset + entry["offset"]
     csize = entry["compressed_size"]
     usize = entry["uncompressed_size"]
@@ -114,12 +173,12 @@ def extract_file(pak_bytes: bytes, entry, base_offset: int, out_dir: pathlib.Pat
     if abs_off + csize > len(pak_bytes):
         raise PakError(f"{entry['path']}: 读取范围越界 (offset {abs_off}, size {csize})")
 
-    payload = pak_bytes[abs_off : abs_off + csize]
+    payload = pak_bytes[abs_off : abs_off + csize]  # pak_bytes 为 memoryview 时是零拷贝切片
 
     if csize != usize:
         try:
-            payload = zlib.decompress(payload, wbits=-15)
-        except zlib.error as exc:
+            payload = inflate_raw(payload, usize)
+        except _INFLATE_ERRORS as exc:
             raise PakError(f"{entry['path']}: 解压失败: {exc}") from exc
 
     if len(payload) != usize:
@@ -127,9 +186,7 @@ def extract_file(pak_bytes: bytes, entry, base_offset: int, out_dir: pathlib.Pat
             f"{entry['path']}: 解压后尺寸不一致，期望 {usize} 实际 {len(payload)}"
         )
 
-    target = out_dir / entry["path"]
-    target.parent.mkdir(parents=True, exist_ok=True)
-    target.write_bytes(payload)
+    (out_dir / entry["path"]).write_bytes(payload)
 
 
 def serialize_entries(entries):
@@ -143,19 +200,41 @@ def serialize_entries(entries):
         out.append(item)
     return out
 
+
+def dump_index(path: pathlib.Path, meta: dict, entries):
+    """导出索引 JSON（UTF-8、缩进 2）；装了 orjson 就直接写 bytes，省去 str 中转。"""
+    payload = {
+        "header": meta,
+        "entries": serialize_entries(entries),
+    }
+    if orjson is not None:
+        path.write_bytes(orjson.dumps(payload, option=orjson.OPT_INDENT_2))
+    else:
+        path.write_text(json.dumps(payload, ensure_ascii=False, indent=2), encoding="utf-8")
+    print(f"索引已导出: {path}")
+
+
 def main():
     parser = argparse.ArgumentParser(description="Extract game.pak contents")
     parser.add_argument("pak", type=pathlib.Path, help="path to game.pak")
     parser.add_argument("-o", "--out", type=pathlib.Path, default=pathlib.Path("extracted"), help="output directory")
     parser.add_argument("--list", action="store_true", help="only list entries")
     parser.add_argument("--dump-index", type=pathlib.Path, help="导出索引为 JSON，便于查阅/汉化时对照")
+    parser.add_argument("-j", "--jobs", type=int, default=os.cpu_count(), help="解压线程数（默认 CPU 核数）")
     args = parser.parse_args()
 
-    pak_bytes = args.pak.read_bytes()
+    # 只读 mmap 整个包，不把整包读进内存；切片经 memoryview 直接交给解压，页缓存由系统管理。
+    # 映射在进程结束时释放（解压出的切片视图可能仍引用它，这里不显式 close）。
+    with args.pak.open("rb") as fp:
+        try:
+            pak_map = mmap.mmap(fp.fileno(), 0, access=mmap.ACCESS_READ)
+        except ValueError as exc:  # 空文件无法映射
+            raise PakError(f"无法映射文件 {args.pak}: {exc}") from exc
+    pak_bytes = memoryview(pak_map)
     meta = read_header(pak_bytes)
 
     index_blob = pak_bytes[meta["index_offset"] : meta["index_offset"] + meta["index_compressed"]]
-    index_data = zlib.decompress(index_blob, wbits=-15)
+    index_data = inflate_raw(index_blob, meta["index_uncompressed"])
     if len(index_data) != meta["index_uncompressed"]:
         raise PakError(
             f"索引尺寸不符，期望 {meta['index_uncompressed']} 实际 {len(index_data)}"
@@ -180,24 +259,21 @@ def main():
                     f"csize={entry['compressed_size']}  usize={entry['uncompressed_size']}"
                 )
         if args.dump_index:
-            payload = {
-                "header": meta,
-                "entries": serialize_entries(entries),
-            }
-            args.dump_index.write_text(json.dumps(payload, ensure_ascii=False, indent=2), encoding="utf-8")
-            print(f"索引已导出: {args.dump_index}")
+            dump_index(args.dump_index, meta, entries)
         return
 
     if args.dump_index:
-        payload = {
-            "header": meta,
-            "entries": serialize_entries(entries),
-        }
-        args.dump_index.write_text(json.dumps(payload, ensure_ascii=False, indent=2), encoding="utf-8")
-        print(f"索引已导出: {args.dump_index}")
-
-    for entry in files:
-        extract_file(pak_bytes, entry, meta["data_offset"], args.out)
+        dump_index(args.dump_index, meta, entries)
+
+    # 先一次性建好所有目标目录，避免多个线程反复 mkdir 同一路径
+    for parent in sorted({(args.out / e["path"]).parent for e in files}):
+        parent.mkdir(parents=True, exist_ok=True)
+
+    # 各文件互不依赖，zlib/libdeflate 解压时释放 GIL，用线程池并发解压/写盘；
+    # 遍历 map 的结果以便把工作线程里的 PakError 抛回主线程。
+    with ThreadPoolExecutor(max_workers=max(1, args.jobs or 1)) as executor:
+        for _ in executor.map(lambda e: extract_file(pak_bytes, e, meta["data_offset"], args.out), files):
+            pass
 
     print(f"Done. Extracted to {args.out}")
 
@@ -0,0 +1,70 @@
+import java.io.BufferedOutputStream;
+import java.io.BufferedReader;
+import java.io.ByteArrayOutputStream;
+import java.io.FileDescriptor;
+import java.io.FileOutputStream;
+import java.io.InputStreamReader;
+import java.io.OutputStream;
+import java.io.PrintStream;
+import java.lang.reflect.Method;
+import java.nio.charset.Charset;
+import java.nio.charset.StandardCharsets;
+
+import unluac.Configuration;
+import unluac.Main;
+import unluac.decompile.Decompiler;
+import unluac.decompile.Output;
+import unluac.parse.LFunction;
+
+/**
+ * 在一个 JVM 里依次反编译多个文件，省去每个文件一次的 JVM 启动开销。
+ * 由 decompiler.py 以源码方式启动（需 Java 11+）：java -cp unluac.jar UnluacBatch.java
+ *
+ * unluac.Main.main 无论成功与否最后都会 System.exit，不能拿来循环调用；
+ * 这里照搬它的反编译分支：file_to_function（私有，反射调用）-> Decompiler.decompile -> print。
+ * 默认的 Output 在打印时才取 System.out，所以把 System.out 临时换成缓冲区即可拿到与 java -jar 相同的输出。
+ *
+ * 协议：stdin 每行一个 .scb 路径（UTF-8）；每处理完一个文件向 stdout 写
+ *   BEGIN\t<status>\t<字节数>\n<unluac 原始输出>END\n
+ * 并立即 flush。status 非 0 表示该文件失败（详情打到 stderr），JVM 继续处理下一行。
+ */
+public class UnluacBatch {
+    public static void main(String[] args) throws Exception {
+        Method fileToFunction = Main.class.getDeclaredMethod("file_to_function", String.class, Configuration.class);
+        fileToFunction.setAccessible(true);
+
+        // 与 java -jar 时 System.out 的编码保持一致（Java 18+ 有 stdout.encoding，之前为默认字符集）
+        String stdoutEncoding = System.getProperty("stdout.encoding");
+        Charset charset = stdoutEncoding != null ? Charset.forName(stdoutEncoding) : Charset.defaultCharset();
+
+        BufferedReader in = new BufferedReader(new InputStreamReader(System.in, StandardCharsets.UTF_8));
+        OutputStream out = new BufferedOutputStream(new FileOutputStream(FileDescriptor.out));
+        PrintStream stdout = System.out;
+        String line;
+        while ((line = in.readLine()) != null) {
+            if (line.isEmpty()) {
+                continue;
+            }
+            ByteArrayOutputStream buf = new ByteArrayOutputStream();
+            PrintStream capture = new PrintStream(buf, false, charset.name());
+            int status = 0;
+            System.setOut(capture);
+            try {
+                LFunction lmain = (LFunction) fileToFunction.invoke(null, line, new Configuration());
+                Decompiler d = new Decompiler(lmain);
+                d.print(d.decompile(), new Output());
+            } catch (Throwable e) {
+                status = 1;
+                e.printStackTrace(System.err);
+            } finally {
+                capture.flush();
+                System.setOut(stdout);
+            }
+            byte[] data = status == 0 ? buf.toByteArray() : new byte[0];
+            out.write(("BEGIN\t" + status + "\t" + data.length + "\n").getBytes(StandardCharsets.US_ASCII));
+            out.write(data);
+            out.write("END\n".getBytes(StandardCharsets.US_ASCII));
+            out.flush();
+        }
+    }
+}
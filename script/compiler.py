@@ -6,21 +6,22 @@
 """
 
 import argparse
+import atexit
 import ctypes
+import functools
+import multiprocessing
+import os
 import struct
+import threading
 from pathlib import Path
 
 
-def load_lua_dll():
-    dll_path = Path(__file__).with_name("lua5.1.dll")
-    if not dll_path.is_file():
-        raise FileNotFoundError(f"lua5.1.dll not found at {dll_path}")
-    return ctypes.WinDLL(str(dll_path))
-
+_DLL_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), "lua5.1.dll")
+_LUA = None
+_LUA_LOCK = threading.Lock()
 
-def compile_lua(lua_src, chunk_name: str = "chunk", encoding: str = "utf-8") -> bytes:
-    lua = load_lua_dll()
 
+def _setup_prototypes(lua):
     lua.luaL_newstate.restype = ctypes.c_void_p
     lua.lua_close.argtypes = [ctypes.c_void_p]
     lua.luaL_openlibs.argtypes = [ctypes.c_void_p]
@@ -30,11 +31,38 @@ def compile_lua(lua_src, chunk_name: str = "chunk", encoding: str = "utf-8") ->
     lua.lua_dump.restype = ctypes.c_int
     lua.lua_tolstring.argtypes = [ctypes.c_void_p, ctypes.c_int, ctypes.POINTER(ctypes.c_size_t)]
     lua.lua_tolstring.restype = ctypes.c_char_p
+    lua.lua_settop.argtypes = [ctypes.c_void_p, ctypes.c_int]
+
 
+def load_lua_dll():
+    # 进程内只检查/加载一次 DLL 并设置函数原型，之后直接返回同一句柄（加锁防止并发首次加载）
+    global _LUA
+    if _LUA is None:
+        with _LUA_LOCK:
+            if _LUA is None:
+                if not os.path.isfile(_DLL_PATH):
+                    raise FileNotFoundError(f"lua5.1.dll not found at {_DLL_PATH}")
+                lua = ctypes.WinDLL(_DLL_PATH)
+                _setup_prototypes(lua)
+                _LUA = lua
+    return _LUA
+
+
+@functools.lru_cache(maxsize=None)
+def lua_state():
+    # 整个进程共用一个 Lua state：openlibs 只跑一次，每次编译后用 lua_settop(L, 0) 清栈即可
+    lua = load_lua_dll()
     L = lua.luaL_newstate()
     if not L:
         raise RuntimeError("failed to create Lua state")
     lua.luaL_openlibs(L)
+    atexit.register(lua.lua_close, L)
+    return L
+
+
+def compile_lua(lua_src, chunk_name: str = "chunk", encoding: str = "utf-8") -> bytes:
+    lua = load_lua_dll()
+    L = lua_state()
 
     # 接受 bytes 或 str，避免编码错误导致无法编译
     if isinstance(lua_src, bytes):
@@ -46,7 +74,7 @@ def compile_lua(lua_src, chunk_name: str = "chunk", encoding: str = "utf-8") ->
         sz = ctypes.c_size_t(0)
         msg = lua.lua_tolstring(L, -1, ctypes.byref(sz))
         err = msg[: sz.value].decode("utf-8", errors="replace") if msg else f"load error code {status}"
-        lua.lua_close(L)
+        lua.lua_settop(L, 0)
         raise RuntimeError(f"lua load error: {err}")
 
     out = bytearray()
@@ -55,21 +83,40 @@ def compile_lua(lua_src, chunk_name: str = "chunk", encoding: str = "utf-8") ->
     @LUA_WRITER
     def writer(_L, p, sz, _ud):
         if sz:
-            out.extend(ctypes.string_at(p, sz))
+            # 以 ctypes 数组视图直接追加（走缓冲区协议），省掉 string_at 生成的中间 bytes
+            out.extend((ctypes.c_char * sz).from_address(p))
         return 0
 
     dump_status = lua.lua_dump(L, writer, None)
-    lua.lua_close(L)
+    lua.lua_settop(L, 0)
     if dump_status != 0:
         raise RuntimeError(f"lua_dump failed with code {dump_status}")
     return bytes(out)
 
 
+def worker_init():
+    # 进程池初始化：每个子进程预先加载 DLL 并创建自己的 Lua state，后续文件复用
+    lua_state()
+
+
+def worker_compile(job):
+    """编译并写出单个文件，返回 (rel, 输出路径, 错误信息)；可在子进程中执行。"""
+    lua_path, dst, rel, encoding = job
+    try:
+        src_bytes = lua_path.read_bytes()
+        bytecode = compile_lua(src_bytes, chunk_name=str(rel), encoding=encoding)
+    except Exception as exc:  # 反编译结果异常也继续处理其他文件
+        return rel, dst, str(exc)
+    dst.write_bytes(bytecode)
+    return rel, dst, None
+
+
 def main():
     parser = argparse.ArgumentParser(description="Compile Lua 5.1 source to bytecode via lua5.1.dll")
     parser.add_argument("input", type=Path, help="path to .lua file or a directory containing .lua files")
     parser.add_argument("-o", "--out", type=Path, help="output file (when input is file) or output directory (when input is directory)")
     parser.add_argument("--encoding", default="shift_jis", help="text encoding for source files (default shift_jis)")
+    parser.add_argument("-j", "--jobs", type=int, default=os.cpu_count(), help="worker processes for folder input (default: CPU count)")
     args = parser.parse_args()
 
     if struct.calcsize("P") * 8 != 32:
@@ -87,22 +134,36 @@ def main():
         raise SystemExit(f"Input not found: {args.input}")
 
     out_dir = args.out if args.out else args.input  # 默认写回同目录结构
-    count = 0
-    failures = []
+    jobs = []
     for lua_path in sorted(args.input.rglob("*.lua")):
         rel = lua_path.relative_to(args.input)
-        dst = (out_dir / rel).with_suffix(".scb")
-        dst.parent.mkdir(parents=True, exist_ok=True)
-        try:
-            src_bytes = lua_path.read_bytes()
-            bytecode = compile_lua(src_bytes, chunk_name=str(rel), encoding=args.encoding)
-        except Exception as exc:  # 反编译结果异常也继续处理其他文件
-            failures.append((rel, str(exc)))
-            print(f"[FAIL] {rel}: {exc}")
-            continue
-        dst.write_bytes(bytecode)
-        count += 1
-        print(f"[OK] {rel} -> {dst}")
+        jobs.append((lua_path, (out_dir / rel).with_suffix(".scb"), rel, args.encoding))
+    for parent in sorted({dst.parent for _, dst, _, _ in jobs}):
+        parent.mkdir(parents=True, exist_ok=True)
+
+    # 编译是纯 CPU 活（Lua 解析器），多文件时开进程池，每个子进程各自持有一个 Lua state
+    workers = max(1, min(args.jobs or 1, len(jobs)))
+    pool = None
+    if workers > 1:
+        pool = multiprocessing.Pool(workers, initializer=worker_init)
+        results = pool.imap(worker_compile, jobs, chunksize=max(1, min(32, len(jobs) // (workers * 4))))
+    else:
+        results = map(worker_compile, jobs)
+
+    count = 0
+    failures = []
+    try:
+        for rel, dst, err in results:
+            if err is not None:
+                failures.append((rel, err))
+                print(f"[FAIL] {rel}: {err}")
+                continue
+            count += 1
+            print(f"[OK] {rel} -> {dst}")
+    finally:
+        if pool is not None:
+            pool.close()
+            pool.join()
 
     if failures:
         print(f"Done with errors. Succeeded: {count}, Failed: {len(failures)}")
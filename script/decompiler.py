@@ -4,18 +4,274 @@
 依赖同目录下的 unluac.jar；保持输入目录的相对路径结构，输出为 .lua。
 """
 import argparse
+import codecs
+import os
+import re
 import subprocess
+import threading
+import zipfile
+from concurrent.futures import ThreadPoolExecutor, as_completed
 from pathlib import Path
 
 
-def run_unluac(jar: Path, src: Path) -> str:
-    """调用 unluac 反编译单个文件，返回 stdout 文本（UTF-8）。"""
+# unluac 输出里 \ddd 使用十进制转义（最多 3 位），其余需要识别的只有 \n \r \t \\
+_ESC_RE = re.compile(rb"\\(\d{1,3}|[nrt\\])")
+
+
+# 每种可能的转义文本 -> 替换结果，预先算好，替换时只做一次字典查找。
+# 十进制转义含前导零的写法（\7、\07、\007）都要覆盖；\n \r \t \\ 保持字面形式。
+_ESCAPE_MAP = {b"\\" + c: b"\\" + c for c in (b"n", b"r", b"t", b"\\")}
+for _n in range(256):
+    for _width in range(len(str(_n)), 4):
+        _ESCAPE_MAP[b"\\" + str(_n).zfill(_width).encode("ascii")] = bytes((_n,))
+del _n, _width
+
+
+def _unescape(m) -> bytes:
+    """十进制转义还原为原始字节，其他转义保持字面形式。"""
+    try:
+        return _ESCAPE_MAP[m.group(0)]
+    except KeyError:  # \256 及以上不是合法的单字节转义
+        raise ValueError(f"escape out of byte range: {m.group(0)!r}") from None
+
+
+# 每个文件一个 JVM、跑完即退：只用 C1 编译器、启用类数据共享，缩短启动/预热时间
+_JAVA_ONESHOT = ["java", "-XX:TieredStopAtLevel=1", "-Xshare:auto"]
+
+
+def read_main_class(jar: str) -> str:
+    """读取 jar 清单里的 Main-Class；jar 无效或没有 Main-Class 时抛 SystemExit。"""
+    try:
+        with zipfile.ZipFile(jar) as zf:
+            manifest = zf.read("META-INF/MANIFEST.MF").decode("utf-8", errors="replace")
+    except (zipfile.BadZipFile, KeyError) as exc:
+        raise SystemExit(f"无效的 jar（{exc}）: {jar}") from None
+    # 清单每行最长 72 字节，以空格开头的行是上一行的续行
+    for line in manifest.replace("\r\n", "\n").replace("\n ", "").splitlines():
+        key, sep, value = line.partition(":")
+        if sep and key.strip().lower() == "main-class":
+            return value.strip()
+    raise SystemExit(f"jar 清单里没有 Main-Class: {jar}")
+
+
+def run_unluac(cmd: list, src: str) -> bytes:
+    """调用 unluac 反编译单个文件，返回原始 stdout 字节（解码交给 write_lua，只做一次）。cmd 为不含文件名的命令前缀。"""
     result = subprocess.run(
-        ["java", "-jar", str(jar), str(src)],
+        cmd + [os.fspath(src)],
         check=True,
         capture_output=True,
     )
-    return result.stdout.decode("shift_jis", errors="replace")
+    return result.stdout
+
+
+_STREAM_CHUNK = 1 << 16
+
+
+def _normalize_newlines(text: str) -> str:
+    # 统一换行，避免 \r\r\n 造成“空一行”。
+    return text.replace("\r\n", "\n").replace("\r", "\n")
+
+
+def stream_unluac(cmd: list, src: str, dst: Path) -> None:
+    """
+    --raw-escapes 时不需要整份文本：边读 unluac 的 stdout 边转码、统一换行并写入 dst，
+    内存里只有一个读缓冲区。失败时删掉写了一半的 dst，并像 run_unluac 一样抛 CalledProcessError。
+    """
+    cmd = cmd + [os.fspath(src)]
+    decoder = codecs.getincrementaldecoder("shift_jis")(errors="replace")
+    pending = ""  # 块末尾的 \r 先留着，下一块开头可能是与它配对的 \n
+    with subprocess.Popen(cmd, stdout=subprocess.PIPE, stderr=subprocess.DEVNULL) as proc:
+        with dst.open("w", encoding="utf-8", newline="\n") as f:
+            for chunk in iter(lambda: proc.stdout.read(_STREAM_CHUNK), b""):
+                text = pending + decoder.decode(chunk)
+                pending = "\r" if text.endswith("\r") else ""
+                f.write(_normalize_newlines(text[: len(text) - len(pending)]))
+            f.write(_normalize_newlines(pending + decoder.decode(b"", final=True)))
+    if proc.returncode:
+        dst.unlink()
+        raise subprocess.CalledProcessError(proc.returncode, cmd)
+
+
+BATCH_LAUNCHER = os.path.join(os.path.dirname(os.path.abspath(__file__)), "UnluacBatch.java")
+
+
+def run_unluac_batch(cmd: list, srcs) -> dict:
+    """
+    用一个 JVM 依次反编译多个文件（cmd 为启动 UnluacBatch.java 的命令），返回 {src: stdout 字节}。
+    失败的文件不在结果里（JVM 意外退出时也只返回已完成的部分），由调用方逐个重试以拿到准确的错误。
+    """
+    request = "".join(f"{src}\n" for src in srcs).encode("utf-8")
+    proc = subprocess.run(
+        cmd,
+        input=request,
+        capture_output=True,
+    )
+    out = proc.stdout
+    results = {}
+    pos = 0
+    for src in srcs:
+        header_end = out.find(b"\n", pos)
+        if header_end == -1:
+            break
+        try:
+            tag, status, size = out[pos:header_end].split(b"\t")
+        except ValueError:
+            break
+        data_end = header_end + 1 + int(size)
+        if tag != b"BEGIN" or out[data_end : data_end + 4] != b"END\n":
+            break
+        if status == b"0":
+            results[src] = out[header_end + 1 : data_end]
+        pos = data_end + 4
+    return results
+
+
+class UnluacServer:
+    """
+    常驻的 unluac JVM（同样用 UnluacBatch.java 启动）：每次写一行路径、读回一段输出，
+    整个运行期间只启动一次 JVM；坏文件只让该条返回失败，JVM 继续服务。JVM 意外退出时下次调用自动重启。
+    """
+
+    def __init__(self, cmd: list):
+        self.cmd = cmd
+        self.proc = None
+
+    def decompile(self, src: str):
+        """返回 unluac 的原始输出；该文件失败或 JVM 中途退出时返回 None，由调用方单独重试。"""
+        if self.proc is None or self.proc.poll() is not None:
+            self.close()
+            self.proc = subprocess.Popen(
+                self.cmd, stdin=subprocess.PIPE, stdout=subprocess.PIPE, stderr=subprocess.DEVNULL
+            )
+        stdin, stdout = self.proc.stdin, self.proc.stdout
+        try:
+            stdin.write(f"{src}\n".encode("utf-8"))
+            stdin.flush()
+            tag, status, size = stdout.readline().split(b"\t")
+            data = stdout.read(int(size))
+            if tag != b"BEGIN" or stdout.read(4) != b"END\n":
+                raise ValueError("unexpected response")
+        except (OSError, ValueError):  # JVM 已退出或输出错位：丢掉这个进程
+            self.close()
+            return None
+        return data if status == b"0" else None
+
+    def close(self) -> None:
+        proc, self.proc = self.proc, None
+        if proc is None:
+            return
+        try:
+            proc.stdin.close()  # JVM 读到 EOF 后自行退出
+        except OSError:
+            pass
+        if proc.poll() is None:
+            try:
+                proc.wait(timeout=10)
+            except subprocess.TimeoutExpired:
+                proc.kill()
+                proc.wait()
+        proc.stdout.close()
+
+
+# 每个工作线程一个常驻 JVM，互不加锁；全部登记下来，结束时统一关闭
+_thread_local = threading.local()
+_servers = []
+_servers_lock = threading.Lock()
+
+
+def thread_server(cmd: list) -> UnluacServer:
+    server = getattr(_thread_local, "server", None)
+    if server is None:
+        server = _thread_local.server = UnluacServer(cmd)
+        with _servers_lock:
+            _servers.append(server)
+    return server
+
+
+def decode_decimal_escapes(raw: bytes, decode) -> str:
+    """
+    unluac 输出里 \\ddd 使用十进制转义；按十进制还原为原始字节，再解码；
+    decode 是 codecs.getdecoder 得到的解码函数，由调用方解析一次后复用。
+    直接在 stdout 原始字节上用正则（C 层）扫描；常见转义 \\n \\r \\t \\\\ 原样保留，
+    避免把 \\n 变成真换行导致字符串破坏。
+    """
+    return decode(_ESC_RE.sub(_unescape, raw), "replace")[0]
+
+
+_decode_shift_jis = codecs.getdecoder("shift_jis")
+
+
+def write_lua(data: bytes, dst: Path, decode, raw_escapes: bool) -> None:
+    """对 unluac 的原始输出做解码（或转义还原）、换行统一后写出 .lua。"""
+    if raw_escapes:
+        text = _decode_shift_jis(data, "replace")[0]
+    else:
+        text = decode_decimal_escapes(data, decode)
+
+    text = _normalize_newlines(text)
+
+    # 全文已在内存且换行已统一：一次编码成 UTF-8 字节直接写出，不经文本 I/O 层逐块编码
+    dst.write_bytes(text.encode("utf-8"))
+
+
+def iter_scb(root: str):
+    """
+    用 os.scandir 遍历 root 下所有 .scb，逐个产出 DirEntry（不跟随目录符号链接，与 rglob 一致）。
+    DirEntry 自带目录项里的类型信息（Windows 上连 stat 也有），不必为每个条目构造 Path 再单独 stat。
+    """
+    stack = [root]
+    while stack:
+        try:
+            with os.scandir(stack.pop()) as it:
+                for entry in it:
+                    if entry.is_dir(follow_symlinks=False):
+                        stack.append(entry.path)
+                    elif os.path.normcase(entry.name).endswith(".scb") and entry.is_file():
+                        yield entry
+        except PermissionError:
+            continue
+
+
+def is_up_to_date(src, dst: Path) -> bool:
+    """dst 已存在、非空且不比 src（Path 或 DirEntry）旧时视为已是最新，可跳过反编译。"""
+    try:
+        dst_stat = dst.stat()
+    except FileNotFoundError:
+        return False
+    return dst_stat.st_size > 0 and dst_stat.st_mtime_ns >= src.stat().st_mtime_ns
+
+
+def process_batch(cmd: list, batch_cmd: list, items, decode, raw_escapes: bool, use_server: bool = False) -> list:
+    """
+    反编译一组文件并写出 .lua：items 为 [(src, dst), ...]，返回 [(src, dst, 异常或 None), ...]。
+    cmd / batch_cmd 分别是单文件、批量启动 unluac 的命令前缀（在 main 里构造一次）。
+    use_server 时交给本线程的常驻 JVM；否则只有一个文件时直接跑 unluac，不值得为它编译启动 UnluacBatch.java。
+    """
+    if use_server:
+        server = thread_server(batch_cmd)
+        outputs = {}
+        for src, _ in items:
+            data = server.decompile(src)
+            if data is not None:
+                outputs[src] = data
+    elif len(items) > 1:
+        outputs = run_unluac_batch(batch_cmd, [src for src, _ in items])
+    else:
+        outputs = {}
+    results = []
+    for src, dst in items:
+        try:
+            data = outputs.get(src)
+            if data is None and raw_escapes:  # 无需还原转义：直接流式写出，不攒整份文本
+                stream_unluac(cmd, src, dst)
+            else:
+                if data is None:  # JVM 中途退出或该文件失败：单独调用一次，拿到准确的错误
+                    data = run_unluac(cmd, src)
+                write_lua(data, dst, decode, raw_escapes)
+            results.append((src, dst, None))
+        except subprocess.CalledProcessError as exc:
+            results.append((src, dst, exc))
+    return results
 
 
 def main():
@@ -38,77 +294,98 @@ def main():
         action="store_true",
         help="不还原 \\ddd 转义（默认会按 --encoding 解码为可读文本）",
     )
+    parser.add_argument(
+        "-j",
+        "--jobs",
+        type=int,
+        default=os.cpu_count(),
+        help="并发反编译的线程数（默认 CPU 核数）",
+    )
+    parser.add_argument(
+        "--batch",
+        type=int,
+        default=0,
+        help="每个 JVM 连续处理的文件数（>1 时启用，通过 UnluacBatch.java 启动，需 Java 11+；默认每个文件启动一次 java）",
+    )
+    parser.add_argument(
+        "--server",
+        action="store_true",
+        help="每个工作线程常驻一个 JVM 处理分到的所有文件（通过 UnluacBatch.java 启动，需 Java 11+）",
+    )
+    parser.add_argument(
+        "--force",
+        action="store_true",
+        help="全部重新反编译（默认跳过比 .scb 新的已有 .lua；改了 --encoding/--raw-escapes 时需加上）",
+    )
     args = parser.parse_args()
 
     jar = args.jar.resolve()
     if not jar.is_file():
         raise SystemExit(f"找不到 unluac.jar: {jar}")
+    # 启动前读一次 jar 清单拿到 Main-Class，之后用 java -cp 直接指定主类，JVM 不必每次再解析清单；
+    # 命令前缀只构造一次，各线程直接复用。批量模式的 JVM 要跑很多文件，不限制 JIT 层级。
+    jar_str = os.fspath(jar)
+    main_class = read_main_class(jar_str)
+    cmd = _JAVA_ONESHOT + ["-cp", jar_str, main_class]
+    batch_cmd = ["java", "-cp", jar_str, BATCH_LAUNCHER]
+
+    # 编码名只解析一次，各线程直接复用解码函数；写错的编码名在这里就报出来
+    try:
+        decode = codecs.getdecoder(args.encoding)
+    except LookupError:
+        raise SystemExit(f"未知的编码: {args.encoding}") from None
 
     input_dir = args.input_dir.resolve()
     output_dir = args.output_dir.resolve()
     if not input_dir.is_dir():
         raise SystemExit(f"输入目录不存在: {input_dir}")
 
-    scb_files = sorted(input_dir.rglob("*.scb"))
-    if not scb_files:
-        raise SystemExit("未找到任何 .scb 文件")
+    # 每个文件都要启动一次 JVM，主要耗时在子进程里，用线程池并发跑；输出只在主线程打印。
+    # --batch N 时每 N 个文件共用一个 JVM，--server 时每个线程全程只用一个 JVM，进一步摊薄启动开销。
+    # 边遍历目录边提交任务，不等整棵树扫完、排好序再开工；目标目录在首次遇到时建一次。
+    batch_size = max(1, args.batch)
+    found = 0
+    made_dirs = set()
+    prefix = os.path.join(os.fspath(input_dir), "")  # 切掉它就是相对路径，省去 relative_to
+    futures = []
+    pending = []
+    skipped = []
+    with ThreadPoolExecutor(max_workers=max(1, args.jobs or 1)) as executor:
+        for entry in iter_scb(os.fspath(input_dir)):
+            found += 1
+            rel = entry.path[len(prefix) :]
+            dst = output_dir / (os.path.splitext(rel)[0] + ".lua")
+            if not args.force and is_up_to_date(entry, dst):
+                skipped.append(f"[SKIP] {rel}")
+                continue
+            if dst.parent not in made_dirs:
+                dst.parent.mkdir(parents=True, exist_ok=True)
+                made_dirs.add(dst.parent)
+            pending.append((entry.path, dst))
+            if len(pending) >= batch_size:
+                futures.append(executor.submit(process_batch, cmd, batch_cmd, pending, decode, args.raw_escapes, args.server))
+                pending = []
+        if pending:
+            futures.append(executor.submit(process_batch, cmd, batch_cmd, pending, decode, args.raw_escapes, args.server))
+        if not found:
+            raise SystemExit("未找到任何 .scb 文件")
 
-    for src in scb_files:
-        rel = src.relative_to(input_dir)
-        dst = output_dir / rel.with_suffix(".lua")
-        try:
-            text = run_unluac(jar, src)
-            if not args.raw_escapes:
-                # unluac 输出里 \ddd 使用十进制转义；按十进制还原为原始字节，再按编码解码。
-                def decode_decimal_escapes(src_text: str, encoding: str) -> str:
-                    buf = bytearray()
-                    i = 0
-                    while i < len(src_text):
-                        ch = src_text[i]
-                        if ch == "\\" and i + 1 < len(src_text):
-                            j = i + 1
-                            digits = ""
-                            while j < len(src_text) and len(digits) < 3 and src_text[j].isdigit():
-                                digits += src_text[j]
-                                j += 1
-                            if digits:
-                                buf.append(int(digits))
-                                i = j
-                                continue
-                            # 保留常见转义为字面形式，避免把 \n 变成真换行导致字符串破坏
-                            nxt = src_text[i + 1]
-                            if nxt == "n":
-                                buf.extend(b"\\n")
-                                i += 2
-                                continue
-                            if nxt == "r":
-                                buf.extend(b"\\r")
-                                i += 2
-                                continue
-                            if nxt == "t":
-                                buf.extend(b"\\t")
-                                i += 2
-                                continue
-                            if nxt == "\\":
-                                buf.extend(b"\\\\")
-                                i += 2
-                                continue
-                        # 其他字符按原样写入单字节
-                        buf.extend(ch.encode("latin-1", errors="replace"))
-                        i += 1
-                    return buf.decode(encoding, errors="replace")
-
-                text = decode_decimal_escapes(text, args.encoding)
-
-            # 统一换行，避免 \r\r\n 造成“空一行”。
-            text = text.replace("\r\n", "\n").replace("\r", "\n")
-
-            dst.parent.mkdir(parents=True, exist_ok=True)
-            with dst.open("w", encoding="utf-8", newline="\n") as f:
-                f.write(text)
-            print(f"[OK] {rel} -> {dst.relative_to(output_dir)}")
-        except subprocess.CalledProcessError as exc:
-            print(f"[FAIL] {rel}: {exc}")
+        # 结果按行攒起来，每批（跳过列表、每个完成的任务）只写一次 stdout，
+        # 重跑时成千上万行 [SKIP] 不会变成成千上万次控制台写入
+        if skipped:
+            print("\n".join(skipped))
+        for future in as_completed(futures):
+            lines = []
+            for src, dst, exc in future.result():
+                rel = src[len(prefix) :]
+                if exc is None:
+                    lines.append(f"[OK] {rel} -> {dst.relative_to(output_dir)}")
+                else:
+                    lines.append(f"[FAIL] {rel}: {exc}")
+            print("\n".join(lines))
+
+    for server in _servers:
+        server.close()
 
 
 if __name__ == "__main__":